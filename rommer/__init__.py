@@ -25,39 +25,163 @@ import os
 import sys
 
 import hashlib
+import mmap
 import pathlib
 import zlib
 
-from sqlalchemy import create_engine, Column, ForeignKey, Integer, String
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from sqlalchemy import create_engine, event, inspect, Column, ForeignKey, Index, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
 log = logging.getLogger(__name__)
 Session = None
 
+# Number of bytes to feed to the checksums at a time.
+CHUNK_SIZE = 1 << 20
+
+# File mtimes below this were stored as seconds rather than nanoseconds;
+# as nanoseconds, it is only 1000 seconds past the epoch.
+LEGACY_MTIME_LIMIT = 10 ** 12
+
+# Maximum number of bound parameters per IN clause; SQLite builds before
+# 3.32 reject statements with more than 999.
+QUERY_CHUNK_SIZE = 900
+
+
+class _Crc32:
+    """
+    A hashlib-style wrapper around zlib.crc32.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+def _feed(hashers, view):
+    # Stream the data once, feeding every hasher per chunk.
+    for offset in range(0, len(view), CHUNK_SIZE):
+        with view[offset:offset + CHUNK_SIZE] as chunk:
+            for hasher in hashers:
+                hasher.update(chunk)
+
+
+def checksums(path):
+    """
+    Compute the size and checksums of the file at the given path.
+    Being a plain module-level function, it can be dispatched to worker
+    processes, e.g. via concurrent.futures.ProcessPoolExecutor.
+    :param path: The path of the file to checksum.
+    :return: A (size, crc, md5, sha1) tuple, with checksums as hex strings.
+    """
+    hashers = (_Crc32(), hashlib.md5(), hashlib.sha1())
+    with open(path, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        # Empty files cannot be mapped; their checksums are the initial ones.
+        if size > 0:
+            # Map the file instead of reading it, avoiding a user-space copy.
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as view:
+                    _feed(hashers, view)
+    crc, md5, sha1 = (hasher.hexdigest() for hasher in hashers)
+    return size, crc, md5, sha1
+
+
+def _scan_dir(path):
+    """
+    List the contents of a single directory.
+    :param path: The directory to list.
+    :return: A (files, subdirs) tuple of path string lists.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.path)
+    except OSError:
+        # Unreadable, or removed since it was found.
+        log.warning('Skipping unreadable directory: %s', path)
+    return files, subdirs
+
+
+def _walk(root):
+    """
+    Recursively list all files beneath the given directory. Directories are
+    scanned concurrently, since on large trees (and network filesystems)
+    the per-directory readdir+stat latency dominates.
+    :param root: The directory to search.
+    :return: A sorted list of file path strings.
+    """
+    files = []
+    workers = min(32, 4 * (os.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_dir, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, subdirs = future.result()
+                files.extend(dir_files)
+                pending.update(executor.submit(_scan_dir, d) for d in subdirs)
+    files.sort()
+    return files
+
 
 def find_files(paths, suffix=None):
     """
     Find all files at or beneath the given paths, of the specified suffix.
     :param paths: The paths to search for matching files.
-    :param suffix: The file extension to which matches should be constrained.
+    :param suffix: The file extension (or tuple of extensions) to which
+                   matches should be constrained, compared case-insensitively.
     :return: A list of matching pathlib.Path objects.
     """
-    # TODO: Handle suffix case-insensitively in a cross-platform way.
-    # https://jdhao.github.io/2019/06/24/python_glob_case_sensitivity/
+    if isinstance(suffix, str):
+        suffix = (suffix,)
+    if suffix is not None:
+        suffix = tuple(s.lower() for s in suffix)
     files = []
     for path in paths:
         if not isinstance(path, pathlib.Path):
             path = pathlib.Path(path)
-        if path.is_file():
-            if suffix is None or path.suffix == suffix:
+        if not path.exists():
+            log.warning('Skipping nonexistent path: %s', path)
+        elif path.is_file():
+            if suffix is None or path.name.lower().endswith(suffix):
                 files.append(path)
         else:
-            glob = f'*.{suffix}' if suffix else '*'
-            files.extend(f for f in path.rglob('*') if f.is_file())
+            files.extend(pathlib.Path(f) for f in _walk(path)
+                         if suffix is None or f.lower().endswith(suffix))
     return files
 
 
+def query_in(query, column, values):
+    """
+    Run the given query once per chunk of values, filtered to rows whose
+    column matches one of them, so that any number of values can be looked
+    up in a handful of statements rather than one statement each.
+    :param query: The query to filter.
+    :param column: The column to compare against the values.
+    :param values: The values to look up.
+    :return: A list of all matching rows.
+    """
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), QUERY_CHUNK_SIZE):
+        rows.extend(query.filter(column.in_(values[i:i + QUERY_CHUNK_SIZE])))
+    return rows
+
+
 def config_dir():
     """
     Get the location where rommer stores its configuration, notably the SQLite3
@@ -86,6 +210,20 @@ def session():
 
     rommer_db_path = config_dir() / 'rommer.db'
     engine = create_engine(f'sqlite:///{rommer_db_path}')
+
+    @event.listens_for(engine, 'connect')
+    def configure_connection(dbapi_connection, connection_record):
+        # Write-ahead logging lets reads proceed during writes, and avoids
+        # a full fsync per commit; memory mapping and a 256 MiB page cache
+        # keep large DAT tables out of repeated read() calls.
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA cache_size=-262144')
+        cursor.execute('PRAGMA mmap_size=1073741824')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+
     Base = declarative_base()
 
 
@@ -98,7 +236,8 @@ def session():
 
         id = Column(Integer, primary_key=True)
 
-        path = Column(String)
+        path = Column(String, index=True)
+        # Nanoseconds, as an integer: float seconds can lose precision.
         mtime = Column(Integer)
         size = Column(Integer)
         crc = Column(String)
@@ -114,29 +253,33 @@ def session():
             # TODO: The below only tells us the file _might_ be dirty.
             # We should then recompute hashes and see if any changed.
             # If not, the file was merely touched, not modified.
-            return self.size is None or self.mtime is None or \
-                   self.size != stat.st_size or self.mtime < stat.st_mtime
-
-        def calculate_checksums(self, recalc=False):
+            if self.size is None or self.mtime is None or self.size != stat.st_size:
+                return True
+            if self.mtime < LEGACY_MTIME_LIMIT:
+                # Stored in seconds by an older version of rommer.
+                return self.mtime < stat.st_mtime
+            return self.mtime < stat.st_mtime_ns
+
+        def needs_checksums(self, recalc=False, stat=None):
+            """
+            Check whether this file's checksums must be (re)computed,
+            discarding any stale values along the way.
+            """
             if not self.path:
                 raise Exception('Cannot calculate checksums without a path')
 
-            stat = self.stat()
+            if stat is None:
+                stat = self.stat()
             if recalc or self.is_dirty(stat):
                 self.size = stat.st_size
-                self.mtime = stat.st_mtime
+                self.mtime = stat.st_mtime_ns
                 self.crc = self.md5 = self.sha1 = None
 
-            if not self.sha1 or not self.md5 or not self.crc:
-                # Read file contents; we need to compute something from it.
-                with open(self.path, 'rb') as fh:
-                    b = fh.read()
-                assert len(b) == self.size
-                if not self.crc:
-                    crc = hex(zlib.crc32(b))[2:]
-                    self.crc = '0'*(8-len(crc)) + crc
-                if not self.md5: self.md5 = hashlib.md5(b).hexdigest()
-                if not self.sha1: self.sha1 = hashlib.sha1(b).hexdigest()
+            return not self.sha1 or not self.md5 or not self.crc
+
+        def calculate_checksums(self, recalc=False):
+            if self.needs_checksums(recalc):
+                self.size, self.crc, self.md5, self.sha1 = checksums(self.path)
 
         def __repr__(self):
             return f"<File(path='{self.path}', size={self.size}, mtime={self.mtime}, sha1={self.sha1}, md5={self.md5}, crc={self.crc})>"
@@ -194,6 +337,9 @@ def session():
         Metadata about a binary ROM file.
         """
         __tablename__ = 'roms'
+        # Covers every column of the report's checksum join, so candidate
+        # rows are found and verified without touching the table itself.
+        __table_args__ = (Index('ix_roms_checksums', 'sha1', 'md5', 'crc', 'size'),)
 
         id = Column(Integer, primary_key=True)
         game_id = Column(Integer, ForeignKey('games.id'))
@@ -215,6 +361,13 @@ def session():
 
 
     Base.metadata.create_all(engine)
+    # create_all skips existing tables, so add any indexes they predate.
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
 
     Session = sessionmaker(bind=engine)
 
@@ -1,7 +1,6 @@
-import collections
-import functools
 import itertools
 import logging
+import numpy as np
 import rommer
 import time
 
@@ -47,26 +46,43 @@ def configure(parser):
 
 def _combine(x, y):
     # TODO: Improve combine function. Result must be in [0, 2**24).
+    # It is applied elementwise to NumPy arrays, so use only ufunc operators.
     return x ^ y
     #return (0xaaa & (x ^ 0xfa7)) | (0x555 & (y ^ 0xc4b))
 
 
-def _count_blocks(values, counts, spread):
+def _histogram(values):
+    # Counts are kept sparse, as (sorted distinct values, their counts),
+    # so memory scales with the number of distinct values, not 2**24.
+    return np.unique(values, return_counts=True)
+
+
+def _merge(h1, h2):
+    values = np.concatenate((h1[0], h2[0]))
+    counts = np.concatenate((h1[1], h2[1]))
+    # Both inputs are sorted, so a stable sort is a cheap merge of two runs.
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    counts = counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[starts], np.add.reduceat(counts, starts)
+
+
+def _count_blocks(values, spread):
     # TODO: Count higher-spread aggregate values with more weight.
     # The question is: how much more?
-    counts.update(values)
-    if len(values) <= spread:
-        # Hash what's left together, to help avoid false 100% reports.
-        fv = [functools.reduce(_combine, values)]
-        print(fv)
-        counts.update(fv)
-        return
+    counts = _histogram(values)
+    while len(values) > spread:
+        # Merge adjacent values (elementwise, over whole arrays); iterating
+        # rather than recursing lets each level's array be freed early.
+        values = _combine(values[:-spread], values[spread:])
+        spread *= 2
+        counts = _merge(counts, _histogram(values))
 
-    # Merge adjacent values and recurse
-    nv = []
-    for i in range(len(values) - spread):
-        nv.append(_combine(values[i], values[i+spread]))
-    _count_blocks(nv, counts, spread * 2)
+    # Hash what's left together, to help avoid false 100% reports.
+    # NB: This reduction must be kept in step with _combine.
+    fv = np.bitwise_xor.reduce(values, keepdims=True)
+    return _merge(counts, _histogram(fv))
 
 
 def count_blocks(p):
@@ -75,26 +91,28 @@ def count_blocks(p):
     with open(p, 'rb') as fh:
         b = fh.read()
     # Count 24-bit triples.
-    counts = collections.Counter()
-    values = []
-    for i in range(0, len(b) - 3, 3):
-        values.append(b[i] | b[i+1]<<8 | b[i+2]<<16)
-    _count_blocks(values, counts, 3)
-    return counts
+    triples = np.frombuffer(b, dtype=np.uint8, count=len(b) // 3 * 3) \
+                .reshape(-1, 3).astype(np.uint32)
+    values = triples[:, 0] | triples[:, 1] << 8 | triples[:, 2] << 16
+    return _count_blocks(values, 3)
 
 
-def similarity(c1, c2):
-    common = sum((c1 & c2).values())
-    total = max(sum(c1.values()), sum(c2.values()))
-    return common / total
+def similarity(c1, t1, c2, t2):
+    (v1, n1), (v2, n2) = c1, c2
+    _, i1, i2 = np.intersect1d(v1, v2, assume_unique=True, return_indices=True)
+    common = np.minimum(n1[i1], n2[i2]).sum()
+    return common / max(t1, t2)
 
 
 def run(args):
     counts = {p: count_blocks(p) for p in args.path}
+    # Sum each file's counts once, rather than once per pairing.
+    totals = {p: c[1].sum() for p, c in counts.items()}
 
     log.info('Computing similarities...')
     maxlen = max(len(p) for p in args.path)
     for p1, p2 in itertools.combinations(counts, 2):
-        print(f'{similarity(counts[p1], counts[p2]):<7.2%} | {p1:<{maxlen}} | {p2}')
+        sim = similarity(counts[p1], totals[p1], counts[p2], totals[p2])
+        print(f'{sim:<7.2%} | {p1:<{maxlen}} | {p2}')
 
     log.info('Comparison complete.')
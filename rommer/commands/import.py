@@ -1,8 +1,12 @@
+import collections
+import itertools
 import logging
 import os
 import rommer
 
-from xml.dom.minidom import parse
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func
+from xml.etree.ElementTree import iterparse, ParseError
 
 log = logging.getLogger(__name__)
 
@@ -14,103 +18,197 @@ def configure(parser):
     parser.add_argument('path', nargs='+', help='file path to search for DATs')
 
 
-def cdata(root, tag):
-    els = root.getElementsByTagName(tag)
-    return els[0].firstChild.wholeText if els else None
-
-
-def parse_dat(path, file=None):
+def parse_dat(path):
+    """
+    Parse the given DAT file. No database access is needed, so DATs can be
+    parsed in worker processes.
+    :return: A (fields, games) tuple, where fields is a mapping of Dat
+             attributes and games is a list of (game, roms) mappings ready
+             for bulk insertion; or None if the file could not be parsed.
+    """
+    header = None
+    games = []
     try:
-        dom = parse(path)
-    except:
-        # Probably not an XML file.
-        log.warning(f'Skipping unparseable file: {path}')
+        # Stream the XML, rather than building the whole document tree;
+        # DATs can contain hundreds of thousands of games.
+        context = iterparse(path, events=('start', 'end'))
+        _, root = next(context)
+        for event, el in context:
+            if event != 'end':
+                continue
+            if el.tag == 'header':
+                header = el
+            elif el.tag == 'machine' or el.tag == 'game':
+                games.append(game(el))
+                # Discard the elements parsed so far, to bound memory use.
+                root.clear()
+    except (ParseError, LookupError, OSError):
+        # Probably not an XML file, or one in an unknown encoding,
+        # or not readable at all.
+        log.warning('Skipping unparseable file: %s', path)
         return None
 
     name = listname = description = version = date = author = url = None
+    if header is not None:
+        name = header.findtext('name')
+        listname = header.findtext('listname')
+        description = header.findtext('description')
+        version = header.findtext('version')
+        date = header.findtext('date')
+        author = header.findtext('author')
+        url = header.findtext('url')
+
+    name_no_ext = os.path.splitext(os.path.basename(path))[0]
+
+    fields = dict(name=name or listname or name_no_ext,
+                  description=description,
+                  version=version,
+                  date=date,
+                  author=author,
+                  url=url)
+
+    return fields, games
+
+
+def read_dat(path, checksum):
+    """
+    Parse the given DAT file and, if requested, checksum it, in one job for
+    a worker process.
+    :return: A (checksums, parsed) tuple; see rommer.checksums and parse_dat.
+             Checksums are None unless requested and the file parses.
+    """
+    parsed = parse_dat(path)
+    if parsed is None or not checksum:
+        return None, parsed
     try:
-        header = dom.getElementsByTagName('header')[0]
-        name = cdata(header, 'name')
-        listname = cdata(header, 'listname')
-        description = cdata(header, 'description')
-        version = cdata(header, 'version')
-        date = cdata(header, 'date')
-        author = cdata(header, 'author')
-        url = cdata(header, 'url')
-    except:
-        pass
-
-    name_no_ext = path[path.rfind('/')+1:path.rfind('.')]
-
-    dat = rommer.Dat(name=name or listname or name_no_ext,
-                     description=description,
-                     version=version,
-                     date=date,
-                     author=author,
-                     url=url)
-    dat.file = file if file else rommer.File(path=path)
-    dat.file.calculate_checksums()
-    dat.games.extend(game(el) for el in dom.getElementsByTagName('machine'))
-    dat.games.extend(game(el) for el in dom.getElementsByTagName('game'))
-
-    return dat
+        return rommer.checksums(path), parsed
+    except OSError:
+        log.warning('Skipping unreadable file: %s', path)
+        return None, None
+
+
+def _imap(executor, fn, jobs, window):
+    # Like executor.map over argument tuples, but with at most window jobs
+    # in flight, so that parsed DATs do not pile up in memory while earlier
+    # ones are inserted.
+    jobs = iter(jobs)
+    futures = collections.deque(executor.submit(fn, *args)
+                                for args in itertools.islice(jobs, window))
+    while futures:
+        result = futures.popleft().result()
+        for args in itertools.islice(jobs, 1):
+            futures.append(executor.submit(fn, *args))
+        yield result
 
 
 def game(el):
-    game = rommer.Game(name=el.getAttribute('name'),
-                       description=cdata(el, 'description'))
-    game.roms.extend([rom(child) for child in el.getElementsByTagName('rom')])
-    return game
+    game = dict(name=el.get('name'),
+                description=el.findtext('description'))
+    return game, [rom(child) for child in el.iter('rom')]
 
 
 def rom(el):
-    return rommer.Rom(name=el.getAttribute('name'),
-                      size=el.getAttribute('size'),
-                      crc=el.getAttribute('crc'),
-                      md5=el.getAttribute('md5'),
-                      sha1=el.getAttribute('sha1'))
+    size = el.get('size')
+    return dict(name=el.get('name'),
+                size=int(size) if size and size.isdigit() else None,
+                crc=el.get('crc'),
+                md5=el.get('md5'),
+                sha1=el.get('sha1'))
+
+
+def insert_dat(session, dat, games):
+    """
+    Add the given DAT, with its games and roms, to the database.
+    Games and roms are inserted with SQLAlchemy Core, bypassing the ORM
+    unit of work, which would otherwise process each one individually.
+    """
+    session.add(dat)
+    session.flush()
+
+    # Assign game IDs up front, so that roms can reference them.
+    game_id = session.query(func.max(rommer.Game.id)).scalar() or 0
+    game_rows = []
+    rom_rows = []
+    for game, roms in games:
+        game_id += 1
+        game.update(id=game_id, dat_id=dat.id)
+        game_rows.append(game)
+        for rom in roms:
+            rom['game_id'] = game_id
+        rom_rows.extend(roms)
+
+    # Core executemany inserts skip the ORM's per-row bookkeeping entirely.
+    if game_rows:
+        session.execute(rommer.Game.__table__.insert(), game_rows)
+    if rom_rows:
+        session.execute(rommer.Rom.__table__.insert(), rom_rows)
 
 
 def run(args):
     session = rommer.session()
 
     log.info('Cataloging DAT files...')
+    datpaths = [str(datfile.resolve()) for datfile in rommer.find_files(args.path, '.dat')]
+    # Look up known files and their DATs in bulk, rather than per DAT file.
+    existing_files = {f.path: f for f in rommer.query_in(session.query(rommer.File),
+                                                         rommer.File.path, datpaths)}
+    existing_dats = {}
+    for d in rommer.query_in(session.query(rommer.Dat), rommer.Dat.file_id,
+                             (f.id for f in existing_files.values())):
+        existing_dats.setdefault(d.file_id, d)
     dats = []
-    for datfile in rommer.find_files(args.path, '.dat'):
-        datpath = str(datfile.resolve())
+    for datpath in datpaths:
         existing_dat = None
-        existing_file = session.query(rommer.File).filter_by(path=datpath).first()
+        existing_file = existing_files.get(datpath)
         if existing_file:
-            existing_dat = session.query(rommer.Dat).filter_by(file_id=existing_file.id).first()
+            existing_dat = existing_dats.get(existing_file.id)
         dats.append((datpath, existing_file, existing_dat))
 
     log.info('Importing DAT files...')
-    pending_rows = 0
+    pending = []
     for datpath, existing_file, existing_dat in dats:
         if existing_dat:
             if existing_file.is_dirty():
                 # Delete DAT and reimport.
-                log.info(f'Reimporting {datpath}...')
+                log.info('Reimporting %s...', datpath)
                 session.delete(existing_dat)
             else:
                 # DAT file has not changed; no action needed.
-                log.info(f'Already imported: {datpath} -> {existing_dat.name}')
+                log.info('Already imported: %s -> %s', datpath, existing_dat.name)
                 continue
         else:
-            log.info(f'Importing {datpath}...')
-
-        # Import DAT.
-        dat = parse_dat(datpath, existing_file)
-        game_count = len(dat.games)
-        rom_count = sum(len(game.roms) for game in dat.games)
-        pending_rows += 1 + game_count + rom_count
-        session.add(dat)
-        log.info(f'--> {dat.name}: {game_count} games / {rom_count} roms')
-
-        if pending_rows >= 10000:
-            # Avoid transactions getting too large.
-            session.commit()
-            pending_rows = 0
+            log.info('Importing %s...', datpath)
+        file = existing_file or rommer.File(path=datpath)
+        # Stat the file before hashing it, so that any change made while
+        # it is hashed is still detected next time.
+        pending.append((file, file.needs_checksums()))
+
+    pending_rows = 0
+    with ProcessPoolExecutor() as executor:
+        # Parse (and checksum, where needed) DATs in parallel; the ORM is
+        # only touched from this process.
+        jobs = [(file.path, needs) for file, needs in pending]
+        results = _imap(executor, read_dat, jobs, 2 * (os.cpu_count() or 1))
+        for (file, needs), (sums, parsed) in zip(pending, results):
+            if parsed is None:
+                continue
+            fields, games = parsed
+            dat = rommer.Dat(**fields)
+            dat.file = file
+            if needs:
+                file.size, file.crc, file.md5, file.sha1 = sums
+
+            # Import DAT.
+            game_count = len(games)
+            rom_count = sum(len(roms) for game, roms in games)
+            pending_rows += 1 + game_count + rom_count
+            insert_dat(session, dat, games)
+            log.info('--> %s: %d games / %d roms', dat.name, game_count, rom_count)
+
+            if pending_rows >= 10000:
+                # Avoid transactions getting too large.
+                session.commit()
+                pending_rows = 0
 
     session.commit()
     log.info('Import complete.')
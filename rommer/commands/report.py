@@ -1,7 +1,10 @@
+import collections
 import logging
 import rommer
 import time
 
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 
 log = logging.getLogger(__name__)
@@ -25,80 +28,105 @@ def run(args):
         log.error('No DATs available. Use "rommer import" first to add some.')
         return 1
 
+    # Files of any other size cannot match a ROM, so need not be hashed.
+    sizes = set(size for size, in session.query(rommer.Rom.size).distinct())
+
     log.info('Cataloging files...')
-    files = []
+    all_paths = set()
+    candidates = []
     for file in rommer.find_files(args.path):
         path = str(file.resolve())
-        existing_file = session.query(rommer.File).filter_by(path=path).first()
-        files.append((path, existing_file))
+        all_paths.add(path)
+        stat = file.stat()
+        if stat.st_size not in sizes:
+            log.info('Skipping %s: no ROM of size %d', path, stat.st_size)
+            continue
+        candidates.append((path, stat))
+    # Only these files have up-to-date checksums; any other known file's
+    # stored checksums may be stale, so must not count as a match.
+    candidate_paths = set(path for path, stat in candidates)
+
+    # Look up known files in bulk, rather than with one query per file.
+    existing_files = {f.path: f for f in rommer.query_in(session.query(rommer.File),
+                                                         rommer.File.path,
+                                                         (path for path, stat in candidates))}
+    files = [(path, stat, existing_files.get(path)) for path, stat in candidates]
 
     log.info('Scanning files...')
-    then = time.time()
-    for path, existing_file in files:
+    pending = []
+    for path, stat, existing_file in files:
         if existing_file:
-            log.info(f'Updating {path}...')
-            existing_file.calculate_checksums()
+            log.info('Updating %s...', path)
+            file = existing_file
         else:
-            log.info(f'Processing {path}...')
+            log.info('Processing %s...', path)
             file = rommer.File(path=path)
-            file.calculate_checksums()
             session.add(file)
-            log.info(f'--> {file.path}: size={file.size}, sha1={file.sha1}, md5={file.md5}, crc={file.crc}')
-        now = time.time()
-        if now - then > 10:
-            # Flush transaction every ~10 seconds.
-            log.info('Committing to DB...')
-            session.commit()
-            then = now
+        if file.needs_checksums(stat=stat):
+            pending.append(file)
+
+    if pending:
+        log.info('Computing checksums for %d files...', len(pending))
+        then = time.time()
+        paths = [file.path for file in pending]
+        with ProcessPoolExecutor() as executor:
+            # Hash files in parallel; the ORM is only touched from this process.
+            results = executor.map(rommer.checksums, paths, chunksize=8)
+            for file, path, sums in zip(pending, paths, results):
+                file.size, file.crc, file.md5, file.sha1 = sums
+                log.info('--> %s: size=%s, sha1=%s, md5=%s, crc=%s',
+                         path, file.size, file.sha1, file.md5, file.crc)
+                now = time.time()
+                if now - then > 10:
+                    # Flush transaction every ~10 seconds.
+                    log.info('Committing to DB...')
+                    session.commit()
+                    then = now
 
     log.info('Committing to DB...')
     session.commit()
 
     log.info('Scanning for matches')
-    files = set(str(file.resolve()) for file in rommer.find_files(args.path))
-    matches = session.query(rommer.Rom, rommer.File) \
+    # Fetch each ROM's DAT id in the same query, rather than lazily per row,
+    # and stream the rows in batches rather than loading them all at once.
+    matches = session.query(rommer.Rom, rommer.File, rommer.Game.dat_id) \
+                     .join(rommer.Rom.game) \
                      .filter(rommer.Rom.sha1 == rommer.File.sha1) \
                      .filter(rommer.Rom.md5 == rommer.File.md5) \
                      .filter(rommer.Rom.crc == rommer.File.crc) \
-                     .filter(rommer.Rom.size == rommer.File.size)
+                     .filter(rommer.Rom.size == rommer.File.size) \
+                     .yield_per(1000)
 
     log.info('Filtering results')
     matched_files = set()
-    matched_dats = set()
     matched_roms = {}
-    count = 0
-    for match in matches:
-        file = match[1]
-        count += 1
-        if not file.path in files:
+    have = collections.Counter()
+    for rom, file, dat_id in matches:
+        if not file.path in candidate_paths:
             continue
         matched_files.add(file.path)
-        rom = match[0]
         if not rom.id in matched_roms:
             matched_roms[rom.id] = []
-        matched_dats.add(rom.game.dat.id)
+            have[dat_id] += 1
         matched_roms[rom.id].append(file.path)
 
     log.info('Calculating statistics')
-    for dat_id in matched_dats:
-        dat = session.query(rommer.Dat) \
-                         .options(joinedload(rommer.Dat.games) \
-                                 .joinedload(rommer.Game.roms)) \
-                         .filter_by(id=dat_id).first()
-        have = 0
-        miss = 0
-        for game in dat.games:
-            for rom in game.roms:
-                if rom.id in matched_roms:
-                    have += 1
-                else:
-                    miss += 1
-        if have > 0:
-            total = have + miss
-            percent = 100 * have / total
-            print(f'{dat.name}: {have}/{total} ({percent}%)')
+    names = dict(rommer.query_in(session.query(rommer.Dat.id, rommer.Dat.name),
+                                 rommer.Dat.id, have))
+    totals = dict(rommer.query_in(session.query(rommer.Game.dat_id, func.count(rommer.Rom.id))
+                                         .join(rommer.Game.roms)
+                                         .group_by(rommer.Game.dat_id),
+                                  rommer.Game.dat_id, have))
+    for dat_id in sorted(have, key=names.get):
+        total = totals[dat_id]
+        percent = 100 * have[dat_id] / total
+        print(f'{names[dat_id]}: {have[dat_id]}/{total} ({percent}%)')
 
         if args.have or args.miss:
+            dat = session.query(rommer.Dat) \
+                             .options(joinedload(rommer.Dat.games) \
+                                     .joinedload(rommer.Game.roms)) \
+                             .filter_by(id=dat_id).first()
             for game in dat.games:
                 for rom in game.roms:
                     match = rom.id in matched_roms
@@ -107,7 +135,7 @@ def run(args):
                     if args.miss and not match:
                         print(f'--> [MISSING] {rom.name}')
 
-    print(f'Unmatched: {len(files) - len(matched_files)} / {len(files)}')
+    print(f'Unmatched: {len(all_paths) - len(matched_files)} / {len(all_paths)}')
     if args.unmatched:
-        for f in sorted(files.difference(matched_files)):
+        for f in sorted(all_paths.difference(matched_files)):
             print(f'--> {f}')
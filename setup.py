@@ -22,6 +22,6 @@ setup(
             'rommer=rommer.__main__:main'
         ]
     },
-    install_requires=['sqlalchemy'],
+    install_requires=['numpy', 'sqlalchemy'],
     python_requires='>=3.6'
 )